@@ -1,25 +1,83 @@
 import os
 import sys
 import json
-from datetime import datetime, timedelta, timezone
+import hashlib
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, time as dtime, timedelta, timezone
+from functools import lru_cache
 from zoneinfo import ZoneInfo
 
+import httplib2
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 
 SCOPES = ["https://www.googleapis.com/auth/calendar.readonly"]
 SGT = ZoneInfo("Asia/Singapore")
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-
-# token.json written at runtime from GitHub Secret GOOGLE_TOKEN_JSON
-if os.getenv("GOOGLE_TOKEN_JSON") and not os.path.exists("token.json"):
-    json.loads(os.getenv("GOOGLE_TOKEN_JSON"))  # validate
-    with open("token.json", "w", encoding="utf-8") as f:
-        f.write(os.getenv("GOOGLE_TOKEN_JSON"))
-
-SENT_FILE = "sent.json"
+TG_SEND_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
+TG_JSON_HEADERS = {"Content-Type": "application/json; charset=utf-8"}
+
+TOKEN_FILE = "token.json"
+
+# GitHub Secret GOOGLE_TOKEN_JSON stands in for token.json at runtime; parsed
+# once here and handed straight to Credentials (a local token.json still wins)
+GOOGLE_TOKEN_INFO = (
+    json.loads(os.environ["GOOGLE_TOKEN_JSON"]) if os.getenv("GOOGLE_TOKEN_JSON") else None
+)
+
+SENT_FILE = "sent.db"
+# Keys are pinned to an event's start time, so a week of history is plenty
+SENT_TTL_SECONDS = 7 * 24 * 60 * 60
+# Stay under SQLite's bound-parameter limit on older builds (999)
+SQLITE_MAX_PARAMS = 500
+
+# Concurrent sends per broadcast; also the adapter's connection pool size so
+# every worker gets its own keep-alive socket
+TG_MAX_WORKERS = 8
+
+# One keep-alive session for every Telegram call, so fan-out to several chats
+# pays the TCP/TLS handshake once instead of once per request. Connection
+# failures and 5xx are retried by the adapter; 429 is handled in tg_send since
+# Telegram puts retry_after in the body. No read retries: the message may
+# already have been delivered.
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=TG_MAX_WORKERS,
+        max_retries=Retry(
+            total=5,
+            read=0,
+            backoff_factor=0.3,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(["POST"]),
+            raise_on_status=False,
+        ),
+    ),
+)
+TG_MAX_ATTEMPTS = 5
+
+# googleapiclient backs off on 403 rate-limit / 429 / 5xx itself when asked to
+GOOGLE_NUM_RETRIES = 4
+GOOGLE_RETRY_STATUSES = (403, 429, 500, 503)
+
+# calendar name -> id, refreshed at most daily or when a routed name is missing
+CALENDAR_CACHE_FILE = "calendars.json"
+CALENDAR_CACHE_TTL_SECONDS = 24 * 60 * 60
+
+# Partial responses: only what format_event_message / the name lookup read
+EVENT_FIELDS = "items(id,summary,description,location,start,end),nextPageToken"
+CALENDAR_FIELDS = "items(id,summary),nextPageToken"
 
 # ✅ Map Google Calendar NAME -> Telegram targets
 # Put your real chat IDs here
@@ -43,43 +101,187 @@ CALENDAR_ROUTES = {
 SKIP_UNMAPPED_CALENDARS = True
 
 
-def load_sent() -> set[str]:
-    try:
-        with open(SENT_FILE, "r", encoding="utf-8") as f:
-            return set(json.load(f))
-    except Exception:
-        return set()
+def open_sent_db() -> sqlite3.Connection:
+    conn = sqlite3.connect(SENT_FILE)
+    # WAL + NORMAL: a commit is an append to the log with no fsync, so marking
+    # a reminder as sent doesn't block the next send on the disk
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS sent(key TEXT PRIMARY KEY, ts INTEGER)")
+    return conn
+
+
+def load_sent(conn: sqlite3.Connection, keys: list[str]) -> set[str]:
+    # Only look up this run's candidate keys instead of pulling the whole table
+    cutoff = int(time.time()) - SENT_TTL_SECONDS
+    sent: set[str] = set()
+    for i in range(0, len(keys), SQLITE_MAX_PARAMS):
+        chunk = keys[i : i + SQLITE_MAX_PARAMS]
+        placeholders = ",".join("?" * len(chunk))
+        rows = conn.execute(
+            f"SELECT key FROM sent WHERE ts >= ? AND key IN ({placeholders})",
+            (cutoff, *chunk),
+        )
+        sent.update(row[0] for row in rows)
+    return sent
+
+
+def mark_sent(conn: sqlite3.Connection, key: str) -> None:
+    # One row per reminder instead of rewriting the whole set every time
+    conn.execute("INSERT OR IGNORE INTO sent VALUES (?, ?)", (key, int(time.time())))
+    conn.commit()
 
 
-def save_sent(sent: set[str]) -> None:
-    with open(SENT_FILE, "w", encoding="utf-8") as f:
-        json.dump(sorted(list(sent)), f)
+def compact_sent(conn: sqlite3.Connection) -> None:
+    # Run once per run, off the per-send path; expired keys are never read again
+    cutoff = int(time.time()) - SENT_TTL_SECONDS
+    conn.execute("DELETE FROM sent WHERE ts < ?", (cutoff,))
+    conn.commit()
 
 
-def tg_send(chat_id: str, text: str, thread_id: int | None = None) -> None:
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-    payload = {"chat_id": chat_id, "text": text}
+def sent_key(ev: dict, cal_id: str) -> str:
+    # Normalise the start to UTC seconds so offset/fraction drift between
+    # API responses can't produce a second key for the same reminder
+    start = ev.get("start", {})
+    if start.get("dateTime"):
+        start_key = (
+            datetime.fromisoformat(start["dateTime"])
+            .astimezone(timezone.utc)
+            .isoformat(timespec="seconds")
+        )
+    else:
+        start_key = start.get("date") or ""
+    raw = f"{cal_id}|{ev.get('id', '')}|{start_key}|T-1"
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class RateLimiter:
+    """Spaces out sends to stay under Telegram's global and per-chat limits.
+
+    Each acquire() reserves the next free slot (global and per chat) under a
+    lock and sleeps until it, so concurrent workers queue up instead of
+    tripping 429s. pause() pushes every pending slot back after a 429.
+    """
+
+    def __init__(self, global_per_sec: float, per_chat_per_sec: float):
+        self._global_gap = 1 / global_per_sec
+        self._chat_gap = 1 / per_chat_per_sec
+        self._lock = threading.Lock()
+        self._next_global = 0.0
+        self._next_chat: dict[str, float] = {}
+
+    def acquire(self, chat_id: str) -> None:
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_global, self._next_chat.get(chat_id, 0.0))
+            self._next_global = slot + self._global_gap
+            self._next_chat[chat_id] = slot + self._chat_gap
+        if slot > now:
+            time.sleep(slot - now)
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self._next_global = max(self._next_global, time.monotonic() + seconds)
+
+
+# Telegram: ~30 messages/s overall, ~1 message/s into the same chat
+TG_LIMITER = RateLimiter(global_per_sec=30, per_chat_per_sec=1)
+
+
+def tg_shared_body(text: str, thread_id: int | None = None) -> bytes:
+    # The sendMessage JSON every chat in a broadcast shares, minus its opening
+    # brace; encoded once so fan-out doesn't re-serialise the text per chat
+    shared: dict = {"text": text}
     if thread_id is not None:
-        payload["message_thread_id"] = thread_id
+        shared["message_thread_id"] = thread_id
+    return json.dumps(shared, ensure_ascii=False)[1:].encode("utf-8")
+
 
-    r = requests.post(url, json=payload, timeout=20)
-    data = r.json()
-    if not data.get("ok"):
-        raise RuntimeError(f"Telegram error for {chat_id}: {data}")
+def tg_send(chat_id: str, shared_body: bytes) -> None:
+    body = b'{"chat_id": ' + json.dumps(chat_id).encode("utf-8") + b", " + shared_body
+
+    data: dict = {}
+    for _ in range(TG_MAX_ATTEMPTS):
+        TG_LIMITER.acquire(chat_id)
+        r = SESSION.post(TG_SEND_URL, data=body, headers=TG_JSON_HEADERS, timeout=20)
+        if r.status_code >= 500:
+            # The adapter has already retried these
+            data = {"ok": False, "error_code": r.status_code, "description": r.text[:200]}
+            break
+
+        data = r.json()
+        if data.get("ok"):
+            return
+        if data.get("error_code") != 429:
+            break
+
+        # Telegram tells us exactly how long to back off for; hold every
+        # sender, not just this one, since the limit is per bot
+        TG_LIMITER.pause(data.get("parameters", {}).get("retry_after", 1))
+
+    raise RuntimeError(f"Telegram error for {chat_id}: {data}")
 
 
 def tg_send_many(chat_ids: list[str], text: str, thread_id: int | None = None) -> None:
-    for cid in chat_ids:
-        tg_send(cid, text, thread_id)
+    shared_body = tg_shared_body(text, thread_id)
+    if len(chat_ids) <= 1:
+        for cid in chat_ids:
+            tg_send(cid, shared_body)
+        return
 
+    # Overlap the round trips; threads release the GIL while waiting on the socket
+    with ThreadPoolExecutor(max_workers=min(len(chat_ids), TG_MAX_WORKERS)) as pool:
+        futures = [pool.submit(tg_send, cid, shared_body) for cid in chat_ids]
+    for fut in futures:
+        fut.result()
 
+
+@lru_cache(maxsize=1)
 def get_calendar_service():
-    creds = Credentials.from_authorized_user_file("token.json", SCOPES)
-    return build("calendar", "v3", credentials=creds)
+    # static_discovery uses the discovery doc bundled with googleapiclient
+    # instead of fetching it; the service (and the one keep-alive Http every
+    # request and batch goes through) is built once per process.
+    if os.path.exists(TOKEN_FILE):
+        creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+    else:
+        creds = Credentials.from_authorized_user_info(GOOGLE_TOKEN_INFO, SCOPES)
+    return build(
+        "calendar",
+        "v3",
+        http=AuthorizedHttp(creds, http=httplib2.Http(timeout=20)),
+        static_discovery=True,
+        cache_discovery=False,
+    )
+
+
+MESSAGE_TEMPLATE = (
+    "{header}: {title}\n"
+    "\n"
+    "{desc_block}"
+    "🗓 Date: {date}\n"
+    "⏰ Time: {time}\n"
+    "📍 Venue: {venue}\n"
+    "\n"
+    "See you all there 🔥"
+)
+
+
+# Fixed English output, formatted by hand rather than through strftime's
+# per-call format parsing (and independent of the runner's locale)
+MONTHS = (
+    "January", "February", "March", "April", "May", "June",
+    "July", "August", "September", "October", "November", "December",
+)
+
+
+def nice_date(d: date) -> str:
+    # Same as d.strftime("%d %B %Y")
+    return f"{d.day:02d} {MONTHS[d.month - 1]} {d.year}"
 
 
 def nice_time(dt: datetime) -> str:
-    return dt.strftime("%I:%M %p").lstrip("0")
+    # Same as dt.strftime("%I:%M %p").lstrip("0")
+    return f"{dt.hour % 12 or 12}:{dt.minute:02d} {'AM' if dt.hour < 12 else 'PM'}"
 
 
 def format_event_message(ev: dict, *, calendar_name: str, is_test: bool) -> str:
@@ -97,33 +299,32 @@ def format_event_message(ev: dict, *, calendar_name: str, is_test: bool) -> str:
             if end.get("dateTime")
             else start_dt + timedelta(hours=1)
         )
-        date_str = start_dt.strftime("%d %B %Y")
+        date_str = nice_date(start_dt)
         time_str = f"{nice_time(start_dt)} - {nice_time(end_dt)}"
     else:
         date_only = datetime.fromisoformat(start["date"]).date()
-        date_str = date_only.strftime("%d %B %Y")
+        date_str = nice_date(date_only)
         time_str = "All day"
 
-    header = "🧪 TEST Reminder" if is_test else "📢 Reminder"
-
-    lines = [f"{header}: {title}", ""]
-    if desc:
-        lines += [desc, ""]
-    lines += [
-        f"🗓 Date: {date_str}",
-        f"⏰ Time: {time_str}",
-        f"📍 Venue: {location}",
-        "",
-        "See you all there 🔥",
-    ]
-    return "\n".join(lines).strip()
+    return MESSAGE_TEMPLATE.format(
+        header="🧪 TEST Reminder" if is_test else "📢 Reminder",
+        title=title,
+        desc_block=f"{desc}\n\n" if desc else "",
+        date=date_str,
+        time=time_str,
+        venue=location,
+    )
 
 
 def list_calendars(service) -> list[dict]:
     items: list[dict] = []
     page_token = None
     while True:
-        res = service.calendarList().list(pageToken=page_token).execute()
+        res = (
+            service.calendarList()
+            .list(pageToken=page_token, fields=CALENDAR_FIELDS)
+            .execute(num_retries=GOOGLE_NUM_RETRIES)
+        )
         items.extend(res.get("items", []))
         page_token = res.get("nextPageToken")
         if not page_token:
@@ -131,71 +332,179 @@ def list_calendars(service) -> list[dict]:
     return items
 
 
-def list_events_tomorrow(service, calendar_id: str) -> list[dict]:
-    now = datetime.now(SGT)
-    start = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-    end = start + timedelta(days=1)
+def cached_calendar_ids() -> dict[str, str] | None:
+    try:
+        if time.time() - os.path.getmtime(CALENDAR_CACHE_FILE) > CALENDAR_CACHE_TTL_SECONDS:
+            return None
+        with open(CALENDAR_CACHE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
 
-    res = service.events().list(
+def fetch_calendar_ids(service) -> dict[str, str]:
+    name_to_id: dict[str, str] = {}
+    for cal in list_calendars(service):
+        name = (cal.get("summary") or "").strip()
+        cid = cal.get("id")
+        if name and cid:
+            name_to_id[name] = cid
+
+    with open(CALENDAR_CACHE_FILE, "w", encoding="utf-8") as f:
+        json.dump(name_to_id, f)
+    return name_to_id
+
+
+def route_calendar_ids(name_to_id: dict[str, str]) -> dict[str, str]:
+    # Only process calendars you mapped
+    route_ids: dict[str, str] = {}
+    for cal_name in CALENDAR_ROUTES:
+        cal_id = name_to_id.get(cal_name)
+        if not cal_id:
+            print(f"⚠️ Calendar not found in calendarList: {cal_name}")
+            continue
+        route_ids[cal_name] = cal_id
+    return route_ids
+
+
+def tomorrow_window() -> tuple[datetime, datetime]:
+    tomorrow = datetime.now(SGT).date() + timedelta(days=1)
+    start = datetime.combine(tomorrow, dtime.min, tzinfo=SGT)
+    return start, start + timedelta(days=1)
+
+
+def events_tomorrow_request(
+    service, calendar_id: str, window: tuple[datetime, datetime], page_token: str | None = None
+):
+    start, end = window
+    return service.events().list(
         calendarId=calendar_id,
-        timeMin=start.astimezone(timezone.utc).isoformat(),
-        timeMax=end.astimezone(timezone.utc).isoformat(),
+        pageToken=page_token,
+        # RFC 3339 with the +08:00 offset is accepted as-is; no UTC detour
+        timeMin=start.isoformat(),
+        timeMax=end.isoformat(),
         singleEvents=True,
         orderBy="startTime",
         maxResults=50,
-    ).execute()
+        fields=EVENT_FIELDS,
+    )
 
-    return res.get("items", [])
+
+def list_events_tomorrow(
+    service, calendar_id: str, window: tuple[datetime, datetime], page_token: str | None = None
+) -> list[dict]:
+    items: list[dict] = []
+    while True:
+        res = events_tomorrow_request(service, calendar_id, window, page_token).execute(
+            num_retries=GOOGLE_NUM_RETRIES
+        )
+        items.extend(res.get("items", []))
+        page_token = res.get("nextPageToken")
+        if not page_token:
+            break
+    return items
+
+
+def list_events_tomorrow_batch(
+    service, calendar_ids: dict[str, str], window: tuple[datetime, datetime]
+) -> dict[str, list[dict]]:
+    """Fetch tomorrow's events for every calendar (name -> id) in one HTTP round trip."""
+    results: dict[str, list[dict]] = {}
+    next_pages: dict[str, str] = {}
+    errors: dict[str, Exception] = {}
+
+    def on_response(request_id, response, exception):
+        if exception is not None:
+            errors[request_id] = exception
+            return
+        results[request_id] = response.get("items", [])
+        if response.get("nextPageToken"):
+            next_pages[request_id] = response["nextPageToken"]
+
+    batch = service.new_batch_http_request(callback=on_response)
+    for cal_name, cal_id in calendar_ids.items():
+        batch.add(events_tomorrow_request(service, cal_id, window), request_id=cal_name)
+    batch.execute()
+
+    # Batches don't retry sub-requests, so redo rate-limited ones one by one
+    for cal_name, exc in errors.items():
+        if isinstance(exc, HttpError) and exc.resp.status in GOOGLE_RETRY_STATUSES:
+            results[cal_name] = list_events_tomorrow(service, calendar_ids[cal_name], window)
+        else:
+            raise exc
+
+    # Busy days spill past the first page; follow those calendars on their own
+    for cal_name, page_token in next_pages.items():
+        results[cal_name] += list_events_tomorrow(
+            service, calendar_ids[cal_name], window, page_token
+        )
+    return results
 
 
 def run_daily(*, is_test: bool):
     if not TELEGRAM_TOKEN:
         raise RuntimeError("Missing TELEGRAM_TOKEN.")
-    if not os.path.exists("token.json"):
-        raise RuntimeError("token.json not found (GOOGLE_TOKEN_JSON secret missing or not written).")
+    if GOOGLE_TOKEN_INFO is None and not os.path.exists(TOKEN_FILE):
+        raise RuntimeError("token.json not found and GOOGLE_TOKEN_JSON secret missing.")
 
     service = get_calendar_service()
-    sent = load_sent()
 
-    calendars = list_calendars(service)
-
-    # Build: calendar name -> calendar id
-    name_to_id: dict[str, str] = {}
-    for cal in calendars:
-        name = (cal.get("summary") or "").strip()
-        cid = cal.get("id")
-        if name and cid:
-            name_to_id[name] = cid
+    name_to_id = cached_calendar_ids()
+    from_cache = name_to_id is not None and all(name in name_to_id for name in CALENDAR_ROUTES)
+    if not from_cache:
+        name_to_id = fetch_calendar_ids(service)
+    route_ids = route_calendar_ids(name_to_id)
 
-    # Only process calendars you mapped
-    for cal_name, route in CALENDAR_ROUTES.items():
-        cal_id = name_to_id.get(cal_name)
-        if not cal_id:
-            print(f"⚠️ Calendar not found in calendarList: {cal_name}")
-            continue
+    # One clock read for the whole run so every calendar sees the same window
+    window = tomorrow_window()
+    try:
+        events_by_cal = list_events_tomorrow_batch(service, route_ids, window)
+    except HttpError as exc:
+        # A cached id goes stale if a calendar is recreated under the same name
+        if not from_cache or exc.resp.status != 404:
+            raise
+        route_ids = route_calendar_ids(fetch_calendar_ids(service))
+        events_by_cal = list_events_tomorrow_batch(service, route_ids, window)
+
+    # Empty days (most weekends) don't need the sent store at all
+    if not any(events_by_cal.values()):
+        print("✅ No events tomorrow in any routed calendar")
+        return
+
+    keys_by_cal = {
+        cal_name: [sent_key(ev, cal_id) for ev in events_by_cal.get(cal_name, [])]
+        for cal_name, cal_id in route_ids.items()
+    }
+    conn = open_sent_db()
+    sent = load_sent(conn, [key for keys in keys_by_cal.values() for key in keys])
 
-        events = list_events_tomorrow(service, cal_id)
+    for cal_name in route_ids:
+        route = CALENDAR_ROUTES[cal_name]
+        events = events_by_cal.get(cal_name, [])
         if not events:
             print(f"✅ No events tomorrow for {cal_name}")
             continue
 
-        for ev in events:
-            ev_id = ev.get("id", "")
-            start = ev.get("start", {})
-            start_key = start.get("dateTime") or start.get("date") or ""
-            key = f"{cal_id}:{ev_id}:{start_key}:T-1"
-
-            if not is_test and key in sent:
-                continue
+        # Test runs ignore the sent store and always resend
+        pending = [
+            (ev, key)
+            for ev, key in zip(events, keys_by_cal[cal_name])
+            if is_test or key not in sent
+        ]
+        if not pending:
+            print(f"✅ Already reminded about all {len(events)} event(s) for {cal_name}")
+            continue
 
+        for ev, key in pending:
             msg = format_event_message(ev, calendar_name=cal_name, is_test=is_test)
             tg_send_many(route["chat_ids"], msg, route.get("thread_id"))
 
             if not is_test:
-                sent.add(key)
+                mark_sent(conn, key)
 
     if not is_test:
-        save_sent(sent)
+        compact_sent(conn)
+    conn.close()
 
 
 if __name__ == "__main__":